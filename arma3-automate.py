@@ -3,12 +3,19 @@
 import os
 import os.path
 import re
+import errno
+import subprocess
+import shlex
+import time
 
-from datetime import datetime
-from urllib import request
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-import json
-import jsonschema
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import httpx
+import orjson
+import fastjsonschema  # type: ignore
 
 import argparse
 
@@ -18,10 +25,7 @@ from colorama import Fore, Style
 
 from enum import Enum
 
-from typing import Any
-from functools import wraps
-
-import glob
+from typing import Any, Callable, cast
 
 
 class LogLevel(Enum):
@@ -36,16 +40,16 @@ class LogLevel(Enum):
 
 class Log:
     _logLevel = LogLevel.INFO
-
-    @staticmethod
-    def requiredLogLevel(level: LogLevel) -> Any:
-        def logLevelDecorator(func: Any):
-            @wraps(func)
-            def wrapper(*args: Any, **kwargs: Any) -> Any:
-                if Log._logLevel.value <= level.value:
-                    return func(*args, **kwargs)
-            return wrapper
-        return logLevelDecorator
+    # lets callers skip building expensive debug messages altogether
+    debugEnabled = False
+
+    _REQUIRED_LOG_LEVELS = {
+        "debug": LogLevel.DEBUG,
+        "info": LogLevel.INFO,
+        "success": LogLevel.ERROR,
+        "warning": LogLevel.WARNING,
+        "error": LogLevel.ERROR,
+    }
 
     @staticmethod
     def _log(msg: str, color: str | None = None, prefix: str = "") -> None:
@@ -54,32 +58,45 @@ class Log:
     @staticmethod
     def setLogLevel(level: LogLevel):
         Log._logLevel = level
+        Log.debugEnabled = level.value <= LogLevel.DEBUG.value
+
+        # bind every public log function once, so that a disabled level
+        # costs a single no-op call instead of a level check per message
+        for name, requiredLevel in Log._REQUIRED_LOG_LEVELS.items():
+            func = getattr(Log, f"_{name}") \
+                if level.value <= requiredLevel.value else Log._disabled
+            setattr(Log, name, staticmethod(func))
 
     @staticmethod
-    @requiredLogLevel(LogLevel.DEBUG)
-    def debug(msg: str) -> None:
+    def _disabled(msg: str) -> None:
+        pass
+
+    @staticmethod
+    def _debug(msg: str) -> None:
         Log._log(msg, color=Fore.CYAN, prefix="DEBUG: ")
 
     @staticmethod
-    @requiredLogLevel(LogLevel.INFO)
-    def info(msg: str) -> None:
+    def _info(msg: str) -> None:
         Log._log(msg, color=Fore.BLUE, prefix="INFO: ")
 
     @staticmethod
-    @requiredLogLevel(LogLevel.ERROR)
-    def success(msg: str) -> None:
+    def _success(msg: str) -> None:
         Log._log(msg, color=Fore.GREEN, prefix="SUCCESS: ")
 
     @staticmethod
-    @requiredLogLevel(LogLevel.WARNING)
-    def warning(msg: str) -> None:
+    def _warning(msg: str) -> None:
         Log._log(msg, color=Fore.YELLOW, prefix="WARNING: ")
 
     @staticmethod
-    @requiredLogLevel(LogLevel.ERROR)
-    def error(msg: str) -> None:
+    def _error(msg: str) -> None:
         Log._log(msg, color=Fore.RED, prefix="ERROR: ")
 
+    debug = _disabled
+    info = _info
+    success = _success
+    warning = _warning
+    error = _error
+
 
 class Config:
 
@@ -90,28 +107,29 @@ class Config:
             "server_directory": {"type": "string"},
             "mod_directory": {"type": "string"},
             "steam_user": {"type": "string"},
-            "mods": {"type": "object"},
+            # workshop ids are numeric, they are sorted as numbers later on
+            "mods": {"type": "object", "additionalProperties": {"type": "string", "pattern": "^[0-9]+$"}},
             "do_game_update": {"type": "boolean"},
             "arma3_workshop_id": {"type": "string"},
         },
         "required": ["steam_cmd", "server_directory", "mod_directory", "mods", "arma3_workshop_id"]
     }
+    # compiled once on import instead of interpreting the schema on every load
+    _validateConfig: Callable[[Any], Any] = fastjsonschema.compile(_CONFIG_SCHEMA)  # type: ignore
 
     def __init__(self, path: str = ".", filename: str = "config.json"):
         try:
-            with open(Path(path) / filename) as jsonFile:
-                configJson = json.load(jsonFile)
-                jsonschema.validate(configJson, Config._CONFIG_SCHEMA)
-                self._configJson = configJson
+            configJson = orjson.loads((Path(path) / filename).read_bytes())
+            Config._validateConfig(configJson)
+            self._configJson = configJson
         except FileNotFoundError:
             Log.error(
                 f"File {path}/{filename} does not exist or is not accessible.")
             exit()
-        except json.decoder.JSONDecodeError as error:
+        except orjson.JSONDecodeError as error:
             Log.error(f"Malformed json file. {error}")
             exit()
-        except jsonschema.ValidationError as error:  # type: ignore
-            # unknownMemberType: ignore
+        except fastjsonschema.JsonSchemaValueException as error:
             Log.error(f"Malformed json file. {error.message}")
             exit()
 
@@ -125,98 +143,256 @@ class Config:
         self.MODS: list[tuple[str, str]] = list(
             self._configJson["mods"].items())
 
-        self.STEAM_USER = str(
-            self._configJson.get("steam_user") if self._configJson.get("steam_user") is not None else None)
+        steamUser = self._configJson.get("steam_user")
+        self.STEAM_USER = str(steamUser) if steamUser is not None else None
 
         self.ARMA_3_WORKSHOP_ID = str(self._configJson["arma3_workshop_id"])
         self.WORKSHOP_DIR = self.SERVER_DIR / \
             f"steamapps/workshop/content/{self.ARMA_3_WORKSHOP_ID}"
+        # plain string variants for path building inside the per mod loops,
+        # Path objects are kept for everything outside of those
+        self.WORKSHOP_DIR_STR = str(self.WORKSHOP_DIR)
+        self.MODS_DIR_STR = str(self.MODS_DIR)
 
 
 class SteamCmdQuery:
-    _baseQuery = ""
-    _parameters: list[str] = []
-
-    def __init__(self, exe: str, forceInstallDir: Path, username: str | None = None, autoQuit: bool = True, runAsSudo: bool = True):
+    def __init__(self, exe: str, forceInstallDir: Path, username: str | None = None, autoQuit: bool = True, runAsSudo: bool = True, parameters: list[list[str]] | None = None):
         self._baseQuery = exe
         self._autoQuit = autoQuit
         self._runAsSudo = runAsSudo
 
-        self.addParameter(f"+force_install_dir {forceInstallDir}")
+        # per instance, a class level list would be shared between queries
+        self._parameters: list[list[str]] = []
+
+        self.addParameter(["+force_install_dir", str(forceInstallDir)])
 
         if username != None:
-            self.addParameter(f"+login {username}")
+            self.addParameter(["+login", username])
 
-    def addParameter(self, parameter: str) -> None:
-        self._parameters.append(parameter)
+        for parameter in parameters or []:
+            self.addParameter(parameter)
 
-    def _getQueryString(self) -> str:
-        parameterString = " ".join(self._parameters)
+    def addParameter(self, parameter: list[str]) -> None:
+        # already split into argv tokens, so paths may contain spaces
+        self._parameters.append(parameter)
 
-        return f"{'sudo ' if self._runAsSudo else ''}{self._baseQuery} {parameterString}"
+    def _getQuery(self) -> list[str]:
+        return (["sudo"] if self._runAsSudo else []) + [self._baseQuery] \
+            + [token for parameter in self._parameters for token in parameter]
 
     def run(self):
         if self._autoQuit:
-            self.addParameter("+quit")
+            self.addParameter(["+quit"])
+
+        query = self._getQuery()
+        if Log.debugEnabled:
+            # quoted, so the logged command can be pasted into a shell
+            Log.debug(shlex.join(query))
+
+        subprocess.run(query, check=False)
+
+
+WORKSHOP_CHANGELOG_URL = "https://steamcommunity.com/sharedfiles/filedetails/changelog"
+# matched against the raw response so the body never has to be decoded
+UPDATE_PATTERN = re.compile(
+    rb"workshopAnnouncement.*?<p id=\"(\d+)\">", re.DOTALL)
+
+# requests are multiplexed over HTTP/2, so a few connections are enough
+MAX_HTTP_CONNECTIONS = 4
+HTTP_TIMEOUT = 10  # seconds
+
+CHANGELOG_CHUNK_SIZE = 16 * 1024
+CHANGELOG_MAX_SIZE = 256 * 1024
+
+
+def _parseUpdatedAt(body: bytes) -> int | None:
+    match = UPDATE_PATTERN.search(body)
+
+    return int(match.group(1)) if match else None
+
+
+def _parseLastModified(header: str) -> int | None:
+    try:
+        lastModified = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return None
+
+    # a "-0000" zone yields a naive datetime, which would be read as local time
+    if lastModified.tzinfo is None:
+        lastModified = lastModified.replace(tzinfo=timezone.utc)
+
+    return int(lastModified.timestamp())
+
+
+async def _scanChangelog(client: httpx.AsyncClient, modId: str) -> int | None:
+    # the timestamp is close to the top of the page, so the body is read in
+    # chunks and the download stops as soon as the pattern matched. Leaving
+    # the stream early only resets this HTTP/2 stream, not the connection.
+    async with client.stream("GET", f"{WORKSHOP_CHANGELOG_URL}/{modId}") as response:
+        response.raise_for_status()
+        body = b""
+
+        async for chunk in response.aiter_bytes(CHANGELOG_CHUNK_SIZE):
+            body += chunk
+            updatedAt = _parseUpdatedAt(body)
+
+            if updatedAt is not None or len(body) >= CHANGELOG_MAX_SIZE:
+                return updatedAt
+
+        return None
+
+
+async def _fetchUpdatedAt(client: httpx.AsyncClient, modId: str) -> int | None:
+    # a HEAD request is sufficient if steam sends a Last-Modified header,
+    # only download and scan the whole changelog if it does not
+    response = await client.head(f"{WORKSHOP_CHANGELOG_URL}/{modId}")
+    lastModified = response.headers.get("Last-Modified")
+
+    if response.is_success and lastModified is not None:
+        updatedAt = _parseLastModified(lastModified)
+        if updatedAt is not None:
+            return updatedAt
+
+    return await _scanChangelog(client, modId)
+
+
+UPDATE_CACHE_FILE = ".update_cache.json"
+UPDATE_CACHE_TTL = 15 * 60  # seconds
+
 
-        queryString = self._getQueryString()
-        Log.debug(queryString)
+def _isValidCacheEntry(entry: Any) -> bool:
+    if not isinstance(entry, dict):
+        return False
 
-        os.system(queryString)
+    entry = cast(dict[str, Any], entry)
+    numbers = (int, float)
+    return isinstance(entry.get("checked_at"), numbers) \
+        and isinstance(entry.get("created_at"), numbers) \
+        and (entry.get("updated_at") is None or isinstance(entry.get("updated_at"), int))
 
 
-def addModDownloadsToQueryParameters(steamCmdQuery: SteamCmdQuery, config: Config) -> SteamCmdQuery:
-    A3_WORKSHOP_DIR = Path(config.SERVER_DIR) / \
-        f"steamapps/workshop/content/{config.ARMA_3_WORKSHOP_ID}"
+def _loadUpdateCache(path: Path) -> dict[str, dict[str, Any]]:
+    # the cache is only an optimization, it must never abort a run
+    try:
+        cache = orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
 
-    def doesModNeedDownload(modId: str, path: Path) -> bool:
-        UPDATE_PATTERN = re.compile(
-            r"workshopAnnouncement.*?<p id=\"(\d+)\">", re.DOTALL)
-        WORKSHOP_CHANGELOG_URL = "https://steamcommunity.com/sharedfiles/filedetails/changelog"
-        if os.path.isdir(path) and os.path.isdir(path / str(modId)):
-            response = request.urlopen(
-                f"{WORKSHOP_CHANGELOG_URL}/{modId}").read()
-            response = response.decode("utf-8")
-            match = UPDATE_PATTERN.search(response)
+    if not isinstance(cache, dict):
+        return {}
 
-            if match:
-                updated_at = datetime.fromtimestamp(int(match.group(1)))
-                created_at = datetime.fromtimestamp(os.path.getctime(path))
+    cache = cast(dict[str, Any], cache)
+    return {modId: entry for modId, entry in cache.items()
+            if _isValidCacheEntry(entry)}
 
-                return updated_at >= created_at
+
+def _saveUpdateCache(path: Path, cache: dict[str, dict[str, Any]]) -> None:
+    try:
+        path.write_bytes(orjson.dumps(cache))
+    except OSError as error:
+        Log.warning(f"Could not write update cache '{path}'. {error}")
+
+
+async def _checkMod(client: httpx.AsyncClient, path: str, modId: str, cache: dict[str, dict[str, Any]], now: float) -> bool:
+    try:
+        # stat calls run in a worker thread so they overlap with the requests
+        createdAt = await asyncio.get_running_loop().run_in_executor(
+            None, os.path.getctime, path)
+    except FileNotFoundError:
+        # mods which are not present locally always need a download
+        return True
+
+    entry = cache.get(modId)
+
+    # a changed ctime means the mod was touched since the last check
+    if entry is None or now - entry["checked_at"] >= UPDATE_CACHE_TTL \
+            or entry["created_at"] != createdAt:
+        try:
+            updatedAt = await _fetchUpdatedAt(client, modId)
+        except httpx.HTTPError as error:
+            # not cached, so the next run checks this mod again
+            Log.warning(
+                f"Update check for {modId} failed, downloading it anyway. {error!r}")
+            return True
+
+        entry = {"checked_at": now,
+                 "updated_at": updatedAt,
+                 "created_at": createdAt}
+        cache[modId] = entry
+    elif Log.debugEnabled:
+        Log.debug(f"Update check for {modId} answered from cache.")
+
+    if entry["updated_at"] is None:
         return True
 
+    return datetime.fromtimestamp(entry["updated_at"]) >= datetime.fromtimestamp(createdAt)
+
+
+async def _checkMods(config: Config, cache: dict[str, dict[str, Any]]) -> dict[str, bool]:
+    # mods listed under several names are only probed once
+    modIds = list(dict.fromkeys(modId for _, modId in config.MODS))
+    now = time.time()
+    limits = httpx.Limits(max_connections=MAX_HTTP_CONNECTIONS,
+                          max_keepalive_connections=MAX_HTTP_CONNECTIONS)
+    # no pool timeout: without HTTP/2 the requests queue for the few connections
+    timeout = httpx.Timeout(HTTP_TIMEOUT, pool=None)
+
+    # one client for all mods so the HTTP/2 connections are shared
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout, follow_redirects=True) as client:
+        results = await asyncio.gather(*(
+            _checkMod(client, f"{config.WORKSHOP_DIR_STR}/{modId}", modId, cache, now)
+            for modId in modIds))
+
+    return dict(zip(modIds, results))
+
+
+def addModDownloadsToQueryParameters(steamCmdQuery: SteamCmdQuery, config: Config, forceCheck: bool = False) -> SteamCmdQuery:
+    cachePath = config.MODS_DIR / UPDATE_CACHE_FILE
+    cache = {} if forceCheck else _loadUpdateCache(cachePath)
+
+    needsDownload = asyncio.run(_checkMods(config, cache))
+
+    _saveUpdateCache(cachePath, cache)
+
+    # mods listed under several names are only downloaded once
+    for modId in sorted((modId for modId, required in needsDownload.items() if required), key=int):
+        steamCmdQuery.addParameter(
+            ["+workshop_download_item", config.ARMA_3_WORKSHOP_ID, modId])
+
     for modName, modId in config.MODS:
-        if doesModNeedDownload(modId, A3_WORKSHOP_DIR):
-            steamCmdQuery.addParameter(
-                f"+workshop_download_item {config.ARMA_3_WORKSHOP_ID} {modId}")
-            Log.debug(
-                f"Added \"{modName}\" ({modId}) to the List of mods to download.")
+        if needsDownload[modId]:
+            if Log.debugEnabled:
+                Log.debug(
+                    f"Added \"{modName}\" ({modId}) to the List of mods to download.")
         else:
             Log.info(
                 f"No download or update required for \"{modName}\" ({modId})... SKIPPING")
-            continue
 
     return steamCmdQuery
 
 
 def addGameUpdateToQueryParameters(steamCmdQuery: SteamCmdQuery) -> SteamCmdQuery:
     ARMA_3_SERVER_ID = "233780"
-    steamCmdQuery.addParameter(f"+app_update {ARMA_3_SERVER_ID} validate")
+    steamCmdQuery.addParameter(["+app_update", ARMA_3_SERVER_ID, "validate"])
 
     return steamCmdQuery
 
 
-def assertAllModsAreDownloaded(config: Config) -> None:
-    def isModDownloaded(modId: str, config: Config) -> bool:
-        path = Path(config.WORKSHOP_DIR) / modId
+def scanDownloadedMods(config: Config) -> set[str]:
+    # a single directory read instead of one stat call per mod
+    try:
+        with os.scandir(config.WORKSHOP_DIR_STR) as entries:
+            # symlinked mod directories (e.g. moved to another disk) count too
+            return {entry.name for entry in entries if entry.is_dir()}
+    except FileNotFoundError:
+        return set()
 
-        return (os.path.isdir(path) is True)
 
+def assertAllModsAreDownloaded(config: Config, downloadedMods: set[str]) -> None:
     abortScript = False
 
     for modName, modId in config.MODS:
-        if not isModDownloaded(modId, config):
+        if modId not in downloadedMods:
             Log.error(
                 f"Mod \"{modName}\" ({modId}) could not be downloaded! Please check steam-cmd error above and retry later.")
             abortScript = True
@@ -226,55 +402,92 @@ def assertAllModsAreDownloaded(config: Config) -> None:
         exit()
 
 
-def createModSymlinks(mods: list[tuple[str, str]], config: Config) -> None:
+def createModSymlinks(mods: list[tuple[str, str]], config: Config, downloadedMods: set[str]) -> None:
     for modName, modId in mods:
-        link_path = f"{config.MODS_DIR}/{modName}"
-        real_path = f"{config.WORKSHOP_DIR}/{modId}"
-
-        if os.path.isdir(real_path):
-            if not os.path.islink(link_path):
-                os.symlink(real_path, link_path)
-                Log.debug("Creating symlink '{link_path}'.")
-            else:
-                Log.debug("Symlink '{link_path}' already present.")
-        else:
+        if modId not in downloadedMods:
             Log.error(
-                f"Mod '{modName}' was expected in {real_path} but is not present. Are there any download errors?")
+                f"Mod '{modName}' was expected in {config.WORKSHOP_DIR_STR}/{modId} but is not present. Are there any download errors?")
             exit()
 
+    # resolve all paths up front so the loop below only issues the syscalls
+    plan = [(f"{config.WORKSHOP_DIR_STR}/{modId}", f"{config.MODS_DIR_STR}/{modName}")
+            for modName, modId in mods]
+
+    abortScript = False
+
+    for real_path, link_path in plan:
+        try:
+            os.symlink(real_path, link_path)
+            if Log.debugEnabled:
+                Log.debug(f"Creating symlink '{link_path}'.")
+        except FileExistsError:
+            # only stat the path if something is already in the way
+            if not os.path.islink(link_path):
+                raise
+            if Log.debugEnabled:
+                Log.debug(f"Symlink '{link_path}' already present.")
+        except OSError as error:
+            if error.errno not in (errno.EMFILE, errno.ENOENT):
+                raise
+            Log.error(f"Could not create symlink '{link_path}'. {error}")
+            abortScript = True
+
+    if abortScript:
+        Log.error("Unrecoverable error. ABORTING!!!")
+        exit()
+
 def toLowercase(config: Config) -> None:
    os.system(r"(cd {} && find . -depth -exec rename -v 's/(.*)\/([^\/]*)/$1\/\L$2/' {} \;)".format(config.ARMA_3_WORKSHOP_ID))
 
-def download_mods(config: Config) -> None:
+def download_mods(config: Config, forceCheck: bool = False) -> None:
     steamCmdQuery = SteamCmdQuery(
         config.STEAM_CMD, config.SERVER_DIR, config.STEAM_USER)
 
-    steamCmdQuery = addModDownloadsToQueryParameters(steamCmdQuery, config)
+    steamCmdQuery = addModDownloadsToQueryParameters(
+        steamCmdQuery, config, forceCheck)
 
     Log.info("Starting Steam-CMD for automatic download/update.")
     steamCmdQuery.run()
     Log.info("Downloading Complete")
     
-    assertAllModsAreDownloaded(config)
+    downloadedMods = scanDownloadedMods(config)
+    assertAllModsAreDownloaded(config, downloadedMods)
     
     toLowercase(config)
 
     Log.info("Creating Mod directories (symbolic links)")
-    createModSymlinks(config.MODS, config)
+    createModSymlinks(config.MODS, config, downloadedMods)
 
     Log.success("All Mods successfully downloaded!")
 
 
+MAX_DELETE_WORKERS = 8
+
+
+def _removeModLink(entry: os.DirEntry[str]) -> None:
+    if entry.is_symlink() or entry.name == UPDATE_CACHE_FILE:
+        os.unlink(entry.path)
+    elif entry.is_dir(follow_symlinks=False):
+        # this script only creates symlinks, anything else belongs to the user
+        Log.warning(
+            f"'{entry.path}' is a directory and not a mod symlink... SKIPPING")
+
+
 def clean(config: Config) -> None:
     if os.path.isdir(config.WORKSHOP_DIR):
         Log.debug(f"Deleting '{config.WORKSHOP_DIR}'")
         shutil.rmtree(config.WORKSHOP_DIR)
 
     if os.path.isdir(config.MODS_DIR):
-        Log.debug(f"Deleting '{config.MODS_DIR}/*'")
-        modFolders = glob.glob(f"{config.MODS_DIR}/*'")
-        for f in modFolders:
-            os.unlink(f)
+        Log.debug(f"Deleting mod symlinks in '{config.MODS_DIR}'")
+        # scanned instead of derived from the config, so links of mods that
+        # were removed from the config are cleaned up as well
+        with os.scandir(config.MODS_DIR_STR) as entries:
+            modEntries = list(entries)
+
+        # deleting symlinks is bound by syscall latency
+        with ThreadPoolExecutor(max_workers=MAX_DELETE_WORKERS) as executor:
+            list(executor.map(_removeModLink, modEntries))
 
     Log.info("Auxiliary files deleted.")
     
@@ -289,6 +502,8 @@ if __name__ == "__main__":
         '--clean', help='deletes all downloaded mods and auxiliary files', action="store_true")
     parser.add_argument(
         "--no-download-mods", action="store_true", help="stops the download of mods but still processes the other flags (debug)")
+    parser.add_argument(
+        "--force-check", action="store_true", help="ignores cached update checks and queries steam for every mod")
     parser.add_argument(
         "--log-level", choices=[level.name for level in list(LogLevel)], help="Sets Log-Level to the specified option")
     args = parser.parse_args()
@@ -303,4 +518,4 @@ if __name__ == "__main__":
         clean(config)
 
     if not args.no_download_mods:
-        download_mods(config)
+        download_mods(config, args.force_check)